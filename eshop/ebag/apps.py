@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class EbagConfig(AppConfig):
     name = 'ebag'
     verbose_name = 'Ebag.bg - Buy food online and save time!'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,13 @@
+from .views import GeneralContextMixin
+
+
+def common_data(request):
+    """
+    Adds to the context of every template rendered with a request
+    the categories tree and the cart data, see
+    GeneralContextMixin.common_data().
+
+    :param request: passed from Django
+    :type request:  WSGIRequest
+    """
+    return GeneralContextMixin.common_data(request)
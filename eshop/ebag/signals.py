@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Category
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_categories_cache(sender, **kwargs):
+    """
+    Removes the cached categories tree and the rendered
+    categories menu, so that they're reloaded from the DB
+    on the next request.
+    """
+    cache.delete_many([
+        settings.CATEGORIES_CACHE_KEY,
+        make_template_fragment_key("categories_nav"),
+    ])
@@ -1,20 +1,24 @@
 import os
 import json
 import unittest
+from unittest import mock
 from datetime import datetime
+from decimal import Decimal
 from django.test import TestCase, Client
 from django.test.client import RequestFactory
 from django.test.utils import setup_test_environment, teardown_test_environment
 from django.urls import reverse
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.template.defaultfilters import slugify
 from django.contrib import admin
 from .templatetags import add_pk_to_slug
 from .models import Category, Product
 from .forms import CategoryForm, CheckoutForm
 from .admin import CategoryDraggableMPTTAdmin, ProductModelAdmin
-from . import views
+from . import views, context_processors
 from mptt.admin import DraggableMPTTAdmin
 from django.core.files.uploadedfile import SimpleUploadedFile
 
@@ -51,6 +55,13 @@ class TestingHelper(object):
         self.product = Product.objects.create(**product_data)
         self.product_data = product_data
 
+    def clear_cache(self):
+        """
+        Clears the cached categories and template fragments,
+        which outlive the rolled back test transactions.
+        """
+        cache.clear()
+
     def delete_product_image(self):
         """
         Deletes the uploaded by create_cat_and_product() product image.
@@ -294,8 +305,9 @@ class CategoryTestCase(TestCase):
 #############################
 
 
-class GeneralContextMixinTestCase(TestCase):
+class GeneralContextMixinTestCase(TestCase, TestingHelper):
     def setUp(self):
+        self.clear_cache()
         self.factory = RequestFactory()
         self.request = self.factory.get('/')
         self.request.session = {}
@@ -311,10 +323,59 @@ class GeneralContextMixinTestCase(TestCase):
         self.assertTrue("categories" in common_data)
         self.assertEqual(len(common_data["categories"]), 1)
         self.assertEqual(
-            common_data["categories"].values()[0]["id"],
+            common_data["categories"][0].pk,
             self.cat.pk
         )
 
+    def test_categories_cache(self):
+        """
+        Test if the categories are served from the cache and if the
+        cache is invalidated after a category is saved or deleted.
+        """
+        common_data = views.GeneralContextMixin.common_data(self.request)
+        self.assertIsNone(cache.get(settings.CATEGORIES_CACHE_KEY))
+        len(common_data["categories"])
+        self.assertIsNotNone(cache.get(settings.CATEGORIES_CACHE_KEY))
+        new_cat = Category.objects.create(name="new-cat")
+        self.assertIsNone(cache.get(settings.CATEGORIES_CACHE_KEY))
+        request = self.factory.get('/')
+        request.session = {}
+        common_data = views.GeneralContextMixin.common_data(request)
+        self.assertEqual(len(common_data["categories"]), 2)
+        new_cat.delete()
+        self.assertIsNone(cache.get(settings.CATEGORIES_CACHE_KEY))
+
+    def test_common_data_context_processor(self):
+        """
+        Test if the context processor passes common_data() to the
+        templates rendered by the views.
+        """
+        self.assertEqual(
+            context_processors.common_data(self.request),
+            views.GeneralContextMixin.common_data(self.request)
+        )
+        response = Client().get(reverse("home_view"))
+        self.assertTrue("categories" in response.context)
+        self.assertEqual(response.context["items_in_cart"], 0)
+
+    def test_categories_nav_fragment_cache(self):
+        """
+        Test if the rendered categories menu is cached and if the
+        cache is invalidated after a category is saved.
+        """
+        fragment_key = make_template_fragment_key("categories_nav")
+        Category.objects.create(name="nav-cat")
+        response = Client().get(reverse("home_view"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("nav-cat", cache.get(fragment_key))
+        # The cached fragment is rendered without loading the categories
+        cache.delete(settings.CATEGORIES_CACHE_KEY)
+        with self.assertNumQueries(0):
+            Client().get(reverse("home_view"))
+        self.assertIsNone(cache.get(settings.CATEGORIES_CACHE_KEY))
+        Category.objects.create(name="new-cat")
+        self.assertIsNone(cache.get(fragment_key))
+
     def test_common_data_empty_cart(self):
         """
         Test if common_data() returns proper data when there
@@ -327,29 +388,62 @@ class GeneralContextMixinTestCase(TestCase):
     def test_common_data_non_empty_cart(self):
         """
         Test if common_data() returns proper data when there
-        are items in the cart stored in the session.
+        are items in the cart stored in the session, without
+        loading the cart products from the DB.
+        """
+        self.request.session = {"cart": {"5": 1}}
+        with self.assertNumQueries(0):
+            common_data = views.GeneralContextMixin.common_data(self.request)
+        self.assertIsInstance(common_data, dict)
+        self.assertEqual(common_data["items_in_cart"], 1)
+
+    def test_get_cart_items(self):
+        """
+        Test if get_cart_items() returns the cart products data
+        loaded from the DB and the cart total.
         """
         quantity = 2
-        price = 4.99
+        price = Decimal("4.99")
+        product = Product.objects.create(
+            name="Milk",
+            category=self.cat,
+            description="Milk is good",
+            price=price,
+            image="milk.png"
+        )
         self.request.session = {
             "cart": {
-                "5": {
-                    "quantity": quantity,
-                    "product_data": {
-                        "id": 1,
-                        "price": price,
-                    }
-                }
+                str(product.pk): quantity
             }
         }
-        common_data = views.GeneralContextMixin.common_data(self.request)
-        self.assertIsInstance(common_data, dict)
+        with self.assertNumQueries(1):
+            cart, cart_total = views.GeneralContextMixin.get_cart_items(
+                self.request)
         self.assertEqual(
-            common_data["cart"],
-            [self.request.session["cart"]["5"]]
+            cart,
+            [{
+                "quantity": quantity,
+                "product_data": {
+                    "id": product.pk,
+                    "name": product.name,
+                    "price": price,
+                    "image": product.image.name,
+                }
+            }]
         )
-        self.assertEqual(common_data["items_in_cart"], 1)
-        self.assertEqual(common_data["cart_total"], quantity * price)
+        self.assertEqual(cart_total, quantity * price)
+
+    def test_common_data_memoized(self):
+        """
+        Test if common_data() is computed only once per request
+        """
+        common_data = views.GeneralContextMixin.common_data(self.request)
+        cache.delete(settings.CATEGORIES_CACHE_KEY)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                views.GeneralContextMixin.common_data(self.request),
+                common_data
+            )
 
     def test_common_data_add_to_ctx_param(self):
         """
@@ -370,11 +464,20 @@ class GeneralContextMixinTestCase(TestCase):
         self.assertEqual(common_data["key"], "val")
 
 
-class FunctionBasedViewsTestCase(TestCase):
+class FunctionBasedViewsTestCase(TestCase, TestingHelper):
     def setUp(self):
+        self.clear_cache()
         self.factory = RequestFactory()
         self.request = self.factory.get('/')
         self.request.session = {}
+        product = Product.objects.create(
+            name="Milk",
+            category=Category.objects.create(name="Dairy"),
+            description="Milk is good",
+            price=2.50,
+            image="milk.png"
+        )
+        self.cart = {str(product.pk): 1}
 
     def test_home_view(self):
         response = views.home_view(self.request)
@@ -394,7 +497,7 @@ class FunctionBasedViewsTestCase(TestCase):
         Test if cart_view loads successfully
         if the cart is not empty
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": self.cart}
         response = views.cart_view(self.request)
         self.assertEqual(response.status_code, 200)
 
@@ -425,7 +528,7 @@ class FunctionBasedViewsTestCase(TestCase):
         the cart is not empty, but user is not coming from
         /cart/
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": self.cart}
         response = views.checkout_view(self.request)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, reverse("home_view"))
@@ -436,11 +539,36 @@ class FunctionBasedViewsTestCase(TestCase):
         if the cart is not empty and the user is coming
         from /cart/
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": self.cart}
         self.request.META["HTTP_REFERER"] = '/cart/'
         response = views.checkout_view(self.request)
         self.assertEqual(response.status_code, 200)
 
+    def test_checkout_view_successful_checkout(self):
+        """
+        Test if after a successful checkout the cart is removed
+        from the session, keeping the rest of it,
+        and the user is redirected to the thank_you view
+        without loading the products from the DB
+        """
+        request = self.factory.post('/checkout/', {
+            'country': "1",
+            'first_name': "John",
+            'last_name': "Smith",
+            'address_1': "Paris str. 5",
+            'post_code': "1234",
+            'phone': "088998877",
+            'state_region': "Catalonia",
+            'email': "leela@example.com",
+        })
+        request.session = {"cart": self.cart, "other": "data"}
+        request.META["HTTP_REFERER"] = '/checkout/'
+        with self.assertNumQueries(0):
+            response = views.checkout_view(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse("thank_you_view"))
+        self.assertEqual(request.session, {"other": "data"})
+
     def test_thank_you_view_valid_referrer(self):
         """
         Test if thank_you view loads successfully
@@ -450,6 +578,17 @@ class FunctionBasedViewsTestCase(TestCase):
         response = views.thank_you_view(self.request)
         self.assertEqual(response.status_code, 200)
 
+    def test_thank_you_view_absolute_referrer(self):
+        """
+        Test if only the path of an absolute referrer URL is checked
+        """
+        self.request.META["HTTP_REFERER"] = 'http://testserver/checkout/'
+        response = views.thank_you_view(self.request)
+        self.assertEqual(response.status_code, 200)
+        self.request.META["HTTP_REFERER"] = 'http://testserver/x/checkout/'
+        response = views.thank_you_view(self.request)
+        self.assertEqual(response.status_code, 302)
+
     def test_thank_you_view_bad_referrer(self):
         """
         Test if thank_you view redirects to home_view
@@ -462,6 +601,7 @@ class FunctionBasedViewsTestCase(TestCase):
 
 class CategoryViewTestCase(TestCase, TestingHelper):
     def setUp(self):
+        self.clear_cache()
         self.create_cat_and_product()
         self.client = Client()
         self.factory = RequestFactory()
@@ -494,11 +634,81 @@ class CategoryViewTestCase(TestCase, TestingHelper):
         self.assertEqual(response.status_code, 200)
         self.assertTrue("categories" in response.context)
         self.assertTrue("products" in response.context)
-        self.assertEqual(response.context["categories"].values()[
-                         0]["id"], self.cat.pk)
+        self.assertEqual(response.context["categories"][0].pk, self.cat.pk)
         self.assertEqual(response.context["products"].values()[
                          0]["id"], self.product.pk)
 
+    def test_category_view_not_found(self):
+        """
+        Test if a 404 is returned for an unexisting category
+        """
+        response = self.client.get(self.view_url.replace(
+            "/" + str(self.cat.pk) + "/", "/" + str(self.cat.pk + 1) + "/"
+        ))
+        self.assertEqual(response.status_code, 404)
+
+    def test_legacy_session_cart(self):
+        """
+        Test if a cart stored in the former format, containing the
+        product data, is dropped instead of breaking the pages
+        """
+        session = self.client.session
+        session["cart"] = {
+            str(self.product.pk): {
+                "quantity": "2",
+                "product_data": {
+                    "id": str(self.product.pk),
+                    "price": "1.22",
+                }
+            }
+        }
+        session.save()
+        response = self.client.get(self.view_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["products"][0]["quantity"], 1)
+        self.assertEqual(response.context["items_in_cart"], 0)
+        self.assertFalse("cart" in self.client.session)
+
+        session = self.client.session
+        session["cart"] = {str(self.product.pk): {"quantity": "2"}}
+        session.save()
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse("home_view"))
+        self.assertFalse("cart" in self.client.session)
+
+        session = self.client.session
+        session["cart"] = {"999": {"quantity": "2", "product_data": {}}}
+        session.save()
+        response = self.client.post(reverse("add_to_cart"), {
+            "items": json.dumps([{
+                "product_id": str(self.product.pk),
+                "quantity": "1",
+            }])
+        })
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["items_in_cart"], 1)
+        self.assertEqual(json_response["cart"], {str(self.product.pk): 1})
+        self.assertEqual(
+            self.client.session["cart"], {str(self.product.pk): 1}
+        )
+
+    def test_category_view_cart_quantity(self):
+        """
+        Test if the displayed product quantity is taken from
+        the session cart and defaults to 1 otherwise.
+        """
+        response = self.client.get(self.view_url)
+        self.assertEqual(response.context["products"][0]["quantity"], 1)
+        self.client.post(reverse("add_to_cart"), {
+            "items": json.dumps([{
+                "product_id": str(self.product.pk),
+                "quantity": "3",
+            }])
+        })
+        response = self.client.get(self.view_url)
+        self.assertEqual(response.context["products"][0]["quantity"], 3)
+
     def tearDown(self):
         self.product.image.delete()
 
@@ -506,6 +716,7 @@ class CategoryViewTestCase(TestCase, TestingHelper):
 class AJAXSessionCartTestCase(TestCase, TestingHelper):
 
     def setUp(self):
+        self.clear_cache()
         self.create_cat_and_product()
         self.client = Client()
         self.factory = RequestFactory()
@@ -613,19 +824,89 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
         json_response = json.loads(response.content)
         self.assertEqual(json_response["success"], 1)
         self.assertEqual(json_response["items_in_cart"], 1)
-        self.assertEqual(json_response["cart"]
-                         [str_product_id]["quantity"], "2")
+        self.assertEqual(json_response["cart"], {str_product_id: 2})
+        self.added_item_id = str_product_id
+
+    def test_add_many_to_cart(self):
+        """
+        Test if many products can be added to cart with a single request
+        and if nothing is added when one of them doesn't exist
+        """
+        second_product = Product.objects.create(
+            name="Milk",
+            category=self.cat,
+            description="Milk is good",
+            price=2.50,
+            image=self.product.image.name
+        )
+        product_ids = [str(self.product.pk), str(second_product.pk)]
+        response = self.client.post(reverse("add_to_cart"), {
+            "items": json.dumps([
+                {"product_id": product_id, "quantity": "3"}
+                for product_id in product_ids
+            ])
+        })
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["success"], 1)
+        self.assertEqual(json_response["items_in_cart"], 2)
+        self.assertEqual(sorted(json_response["cart"]), sorted(product_ids))
+
+        response = self.client.post(reverse("update_cart"), {
+            "items": json.dumps([
+                {"product_id": product_id, "quantity": "1"}
+                for product_id in product_ids + [str(second_product.pk + 1)]
+            ])
+        })
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["success"], 0)
+        self.assertEqual(json_response["err_msg"], settings.ERR_MSG_NO_PRODUCT)
+        self.assertEqual(
+            self.client.session["cart"][product_ids[0]], 3
+        )
+
+    def test_cart_page_products(self):
+        """
+        Test if the cart page displays the products data loaded
+        from the DB for the quantities stored in the session
+        """
+        self.helper_get_response("add_to_cart", str(self.product.pk), "2")
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, self.product.name)
         self.assertEqual(
-            float(
-                json_response["cart"][str_product_id]["product_data"]["price"]
-            ),
-            float(self.product.price)
+            response.context["cart_total"],
+            2 * Product.objects.get(pk=self.product.pk).price
+        )
+
+    def test_cart_deleted_product(self):
+        """
+        Test if a product deleted while in the cart is removed
+        from the session cart when the cart is displayed
+        """
+        other_product = Product.objects.create(
+            name="Milk",
+            category=self.cat,
+            description="Milk is good",
+            price=2.10,
+            image="milk.png",
         )
+        other_product_id = str(other_product.pk)
+        self.helper_get_response("add_to_cart", str(self.product.pk), "2")
+        self.helper_get_response("add_to_cart", other_product_id, "1")
+        other_product.delete()
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["cart"]), 1)
+        self.assertEqual(response.context["items_in_cart"], 1)
         self.assertEqual(
-            json_response["cart"][str_product_id]["product_data"]["id"],
-            str_product_id
+            self.client.session["cart"], {str(self.product.pk): 2}
         )
-        self.added_item_id = str_product_id
+
+        Product.objects.filter(pk=self.product.pk).delete()
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse("home_view"))
+        self.assertFalse("cart" in self.client.session)
 
     def test_update_cart(self):
         """
@@ -639,10 +920,8 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
         json_response = json.loads(response.content)
         self.assertEqual(json_response["success"], 1)
         self.assertEqual(json_response["items_in_cart"], 1)
-        self.assertEqual(json_response["cart"]
-                         [str_product_id]["quantity"], "6")
-        self.assertTrue(
-            "product_data" in json_response["cart"][str_product_id])
+        self.assertEqual(json_response["cart"], {str_product_id: 6})
+        self.assertEqual(self.client.session["cart"], {str_product_id: 6})
 
     def test_delete_from_cart(self):
         """
@@ -668,12 +947,12 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
         self.assertEqual(self.view.err_msg, "")
         self.assertEqual(self.view.cart, {})
         # Non empty cart
-        self.view.request.session = {"cart": "item"}
+        self.view.request.session = {"cart": {"1": 2}}
         self.view.set_init_vars()
         self.assertEqual(self.view.success, 1)
         self.assertEqual(self.view.items_in_cart, 0)
         self.assertEqual(self.view.err_msg, "")
-        self.assertEqual(self.view.cart, "item")
+        self.assertEqual(self.view.cart, {"1": 2})
 
     def test_set_cart(self):
         self.view.request.session["cart"] = "item"
@@ -700,31 +979,20 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
     def test_delete_product_from_cart(self):
         product_id = "5"
         self.view.request.session["cart"] = {}
-        self.view.request.session["cart"][product_id] = "some product data"
+        self.view.request.session["cart"][product_id] = 2
         self.view.delete_product_from_cart(product_id)
         self.assertTrue(product_id not in self.view.request.session["cart"])
 
     def test_update_cart_with_product(self):
         product_id = str(self.product.pk)
-        quantity = "4"
-        product = Product.objects.filter(id=product_id)
+        quantity = 4
         self.view.request.session["cart"] = {}
-        self.view.update_cart_with_product(product_id, quantity, product)
+        self.view.update_cart_with_product(product_id, quantity)
         self.assertTrue(product_id in self.view.request.session["cart"])
-        self.assertIsInstance(
-            self.view.request.session["cart"][product_id], dict)
         self.assertEqual(
-            self.view.request.session["cart"][product_id]["quantity"],
+            self.view.request.session["cart"][product_id],
             quantity
         )
-        product_data = {
-            k: str(v) for k, v in
-            product.values()[0].items()
-        }
-        self.assertEqual(
-            self.view.request.session["cart"][product_id]["product_data"],
-            product_data
-        )
 
     def test_return_json(self):
         cart = {"item": "item_data"}
@@ -739,12 +1007,47 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
         self.assertEqual(json_["items_in_cart"], "5")
         self.assertEqual(json_["cart"], cart)
 
+    def test_json_implementations(self):
+        """
+        Test the AJAX parsing and response both with orjson, whose
+        dumps() returns bytes, and with the stdlib json fallback,
+        whose dumps() returns str.
+        """
+        implementations = [(json.loads, json.dumps)]
+        try:
+            import orjson
+        except ImportError:
+            pass
+        else:
+            implementations.append((orjson.loads, orjson.dumps))
+        str_product_id = str(self.product.pk)
+        for loads, dumps in implementations:
+            with self.subTest(json_module=loads.__module__), \
+                    mock.patch.object(views, "json_loads", loads), \
+                    mock.patch.object(views, "json_dumps", dumps):
+                response = self.helper_get_response(
+                    "add_to_cart", str_product_id, "2")
+                self.assertEqual(response["Content-Type"], "application/json")
+                json_response = json.loads(response.content)
+                self.assertEqual(json_response["success"], 1)
+                self.assertEqual(json_response["cart"], {str_product_id: 2})
+
+                self.view.success = 0
+                self.view.err_msg = "Error msg"
+                self.view.items_in_cart = 0
+                self.view.cart = {}
+                json_response = json.loads(self.view.return_json().content)
+                self.assertEqual(json_response["err_msg"], "Error msg")
+                self.assertEqual(json_response["cart"], {})
+
     def test_is_valid_ajax_input(self):
         self.assertEqual(self.view.is_valid_ajax_input(("4", "5")), True)
         self.assertEqual(self.view.is_valid_ajax_input(("4", 5)), False)
         self.assertEqual(self.view.is_valid_ajax_input((4, 5)), False)
         self.assertEqual(self.view.is_valid_ajax_input(([], {})), False)
         self.assertEqual(self.view.is_valid_ajax_input(("b", "a")), False)
+        self.assertEqual(self.view.is_valid_ajax_input(("4", "²")), False)
+        self.assertEqual(self.view.is_valid_ajax_input(("4", "5\n")), False)
 
     def tearDown(self):
         self.delete_product_image()
@@ -1,29 +1,141 @@
 from django.shortcuts import render, redirect
 from django.views.generic import ListView
 from django.views.generic.base import TemplateView
-from django.http import JsonResponse
+from django.http import HttpResponse, Http404
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
 from .models import Category, Product
 from .forms import CheckoutForm
 from functools import wraps
-import json
+from urllib.parse import urlsplit
+import re
+try:
+    # Optional, considerably faster JSON parsing and serialization
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as json_loads, dumps as json_dumps
 # Create your views here.
 
+DIGITS_RE = re.compile(r"[0-9]+")
+
 
 class GeneralContextMixin:
     """
     Retrives from the DB the most common content
-    shared on many views. Contains only static methods
-    so serves just as a namespace for this group of methods.
+    shared on many views. common_data() is passed to all
+    the templates by the context processor in context_processors.py.
+    Contains only static methods so serves just as a namespace
+    for this group of methods.
     """
 
+    # The only product fields displayed on the cart and checkout pages
+    cart_product_fields = ("id", "name", "price", "image")
+
+    @staticmethod
+    def _get_categories():
+        """
+        Returns the categories tree as a tuple of model instances
+        (needed by the recursetree tag), loading it from the DB only
+        if it's missing in the cache. The cached value is invalidated
+        by the Category post_save/post_delete signals in signals.py.
+        """
+        categories = cache.get(settings.CATEGORIES_CACHE_KEY)
+        if categories is None:
+            categories = tuple(Category.objects.all())
+            cache.set(
+                settings.CATEGORIES_CACHE_KEY,
+                categories,
+                settings.CATEGORIES_CACHE_TIMEOUT
+            )
+        return categories
+
+    @staticmethod
+    def get_session_cart(request):
+        """
+        Returns the session cart of product quantities. Drops from it
+        the entries stored in the former format, where each product
+        was saved as {"quantity": ..., "product_data": ...}.
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        """
+        cart = request.session.get("cart", {})
+        GeneralContextMixin.remove_from_cart(request, [
+            product_id for product_id, quantity in cart.items()
+            if not isinstance(quantity, int)
+        ])
+        return cart
+
+    @staticmethod
+    def remove_from_cart(request, product_ids):
+        """
+        Removes products from the session cart and deletes
+        the cart if it's left empty.
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        :param product_ids: The ids of the removed products
+        :type product_ids: list
+        """
+        if not product_ids:
+            return
+        cart = request.session["cart"]
+        for product_id in product_ids:
+            del cart[product_id]
+        if not cart:
+            GeneralContextMixin.clear_cart(request.session)
+        request.session.modified = True
+
+    @staticmethod
+    def get_cart_items(request):
+        """
+        Returns a tuple of the cart items and the cart total.
+        The session cart contains only the product quantities, so the
+        products data is loaded from the DB with a single query.
+        Products no longer in the DB are removed from the cart.
+        Called only by the views displaying the cart contents.
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        """
+        cart = GeneralContextMixin.get_session_cart(request)
+        products = {
+            product["id"]: product for product in
+            Product.objects.filter(
+                id__in=[int(product_id) for product_id in cart]
+            ).values(*GeneralContextMixin.cart_product_fields)
+        }
+        # Products deleted after being added to the cart
+        GeneralContextMixin.remove_from_cart(request, [
+            product_id for product_id in cart
+            if int(product_id) not in products
+        ])
+        items = [
+            {
+                "quantity": quantity,
+                "product_data": products[int(product_id)]
+            }
+            for product_id, quantity in cart.items()
+        ]
+        cart_total = sum(
+            item["quantity"] * item["product_data"]["price"]
+            for item in items
+        )
+        return items, cart_total
+
     @staticmethod
     def common_data(request, ctx=None):
         """
         Returns common data used in many views:
-        1) Categories tree
-        2) Cart
-        3) items_in_cart
+        1) Categories tree - lazy, so it's not loaded at all when
+        the categories menu is served from the fragment cache
+        2) items_in_cart
+        The cart contents are added only by the views displaying them,
+        see get_cart_items().
+        The data is computed once per request and memoized on it,
+        so repeated calls (e.g. from the context processor and a view)
+        don't query the cache and session again.
         If ctx is passed as a dict, adds its data to the
         returned result as well.
 
@@ -34,30 +146,39 @@ class GeneralContextMixin:
         :type request: dict / NoneType by default
         """
 
+        if not hasattr(request, "_common_data_cache"):
+            data = {
+                'categories': SimpleLazyObject(
+                    GeneralContextMixin._get_categories
+                ),
+                'categories_cache_timeout': settings.CATEGORIES_CACHE_TIMEOUT,
+            }
+            data["items_in_cart"] = len(
+                GeneralContextMixin.get_session_cart(request)
+            )
+            request._common_data_cache = data
         if ctx is None:
             ctx = {}
-        ctx['categories'] = Category.objects.all()
-        ctx["items_in_cart"] = 0
-        if "cart" in request.session:
-            ctx["cart"] = [
-                item for key, item in request.session["cart"].items()
-            ]
-            cart_total = sum([
-                int(item["quantity"]) * float(item["product_data"]["price"])
-                for item in ctx["cart"]
-            ])
-            ctx["cart_total"] = cart_total
-        else:
-            ctx["cart"] = []
-        ctx["items_in_cart"] = len(ctx["cart"])
+        ctx.update(request._common_data_cache)
         return ctx
 
+    @staticmethod
+    def clear_cart(session):
+        """
+        Removes the cart from the session,
+        leaving the rest of the session data untouched.
+
+        :param session: The request session
+        :type session: SessionBase
+        """
+        session.pop("cart", None)
+
     @staticmethod
     def validate_referrer(valid_referrers):
         """
         Decorator.
-        Redirects to the home page if the
-        request referrer is not found in
+        Redirects to the home page if the path
+        of the request referrer is not found in
         the list of valid referrers.
         Use cases:
         1) The user should not go to the checkout
@@ -69,11 +190,13 @@ class GeneralContextMixin:
         :type valid_referrers: list
 
         """
+        valid_referrers = frozenset(valid_referrers)
+
         def outer_wrapper(function):
             @wraps(function)
             def inner_wrapper(request, *args, **kwargs):
-                referrer = str(request.META.get('HTTP_REFERER'))
-                if all(r not in referrer for r in valid_referrers):
+                referrer = urlsplit(request.META.get('HTTP_REFERER') or '')
+                if referrer.path not in valid_referrers:
                     return redirect('home_view')
                 return function(request, *args, **kwargs)
             return inner_wrapper
@@ -104,6 +227,22 @@ class CategoryView(ListView):
     """
     template_name = 'category.html'
     model = Category
+    # The only product fields displayed on the category page
+    product_fields = ("id", "name", "description", "price", "image")
+
+    def get_category(self, cat_id):
+        """
+        Returns the current category from the cached categories tree,
+        so that no separate DB query is needed for it.
+        Raises Http404 if there is no such category.
+
+        :param cat_id: The category id
+        :type cat_id: int
+        """
+        for category in GeneralContextMixin._get_categories():
+            if category.pk == cat_id:
+                return category
+        raise Http404("No category found matching the query")
 
     def get_context_data(self, **kwargs):
         """
@@ -114,36 +253,31 @@ class CategoryView(ListView):
         on the session history
         """
 
-        ctx = super(__class__, self).get_context_data(**kwargs)
-        ctx['category'] = Category.objects.get(id=self.kwargs["cat_id"])
+        ctx = super().get_context_data(**kwargs)
+        ctx['category'] = self.get_category(self.kwargs["cat_id"])
         ctx['products'] = Product.objects.filter(
             category_id=self.kwargs["cat_id"]
-        ).values()
+        ).values(*self.product_fields)
+        cart = GeneralContextMixin.get_session_cart(self.request)
         for product in ctx['products']:
-            product_id = str(product["id"])
-            session = self.request.session
-            if ("cart" not in session or product_id not in session["cart"]):
-                product["quantity"] = 1
-            else:
-                product["quantity"] = session["cart"][product_id]["quantity"]
-        return GeneralContextMixin.common_data(self.request, ctx)
+            product["quantity"] = cart.get(str(product["id"]), 1)
+        return ctx
 
 
 def home_view(request):
-    return render(
-        request,
-        "home.html",
-        GeneralContextMixin.common_data(request)
-    )
+    return render(request, "home.html")
 
 
 @GeneralContextMixin.verify_cart_not_empty
 def cart_view(request):
-    return render(
-        request,
-        "cart.html",
-        GeneralContextMixin.common_data(request)
-    )
+    cart, cart_total = GeneralContextMixin.get_cart_items(request)
+    if not cart:
+        return redirect('home_view')
+    ctx = {
+        "cart": cart,
+        "cart_total": cart_total
+    }
+    return render(request, "cart.html", ctx)
 
 
 @GeneralContextMixin.validate_referrer(['/checkout/'])
@@ -151,11 +285,7 @@ def thank_you_view(request):
     """
     Displayed after successful checkout.
     """
-    return render(
-        request,
-        "thank-you.html",
-        GeneralContextMixin.common_data(request)
-    )
+    return render(request, "thank-you.html")
 
 
 @GeneralContextMixin.verify_cart_not_empty
@@ -165,20 +295,27 @@ def checkout_view(request):
     if request.method == "POST":
         form = CheckoutForm(request.POST)
         if form.is_valid():
-            del request.session["cart"]
-            request.session.save()
+            # The products data isn't needed to complete the checkout
+            if not GeneralContextMixin.get_session_cart(request):
+                return redirect('home_view')
+            GeneralContextMixin.clear_cart(request.session)
             return redirect("thank_you_view")
+    cart, cart_total = GeneralContextMixin.get_cart_items(request)
+    if not cart:
+        return redirect('home_view')
     ctx = {
-        "form": form
+        "form": form,
+        "cart": cart,
+        "cart_total": cart_total
     }
-    return render(
-        request,
-        "checkout.html",
-        GeneralContextMixin.common_data(request, ctx)
-    )
+    return render(request, "checkout.html", ctx)
 
 
 class AJAXSessionCart(TemplateView):
+    """
+    Stores in the session cart the quantity of each product,
+    keyed by the product id.
+    """
     template_name = None
 
     def set_init_vars(self):
@@ -189,6 +326,8 @@ class AJAXSessionCart(TemplateView):
         self.success = 1
         self.items_in_cart = 0
         self.err_msg = ""
+        # Drops the cart entries stored in the former format
+        GeneralContextMixin.get_session_cart(self.request)
         if "cart" not in self.request.session:
             self.request.session["cart"] = {}
         self.cart = self.request.session["cart"]
@@ -201,8 +340,7 @@ class AJAXSessionCart(TemplateView):
         or the session cart if it's not empty.
         """
         if self.items_in_cart < 1:
-            del self.request.session["cart"]
-            self.request.session.save()
+            GeneralContextMixin.clear_cart(self.request.session)
         try:
             self.cart = self.request.session["cart"]
         except KeyError:
@@ -211,37 +349,41 @@ class AJAXSessionCart(TemplateView):
     def post(self, request):
         """
         Sets the default returned values for the JSON output.
-        Validates the input data.
-        Processes each item by saving it in the session cart
+        Validates and parses the input data in a single pass.
+        Checks if all the requested products exist with a single query,
+        processes each item by saving it in the session cart
         and calls the return function.
         """
         self.set_init_vars()
-        for item in json.loads(request.POST["items"]):
-            product_id = item["product_id"]
-            quantity = item["quantity"]
-            if not self.is_valid_ajax_input((product_id, quantity)):
+        items = []
+        for item in json_loads(request.POST["items"]):
+            fields = (item["product_id"], item["quantity"])
+            if not self.is_valid_ajax_input(fields):
                 return self.return_error(settings.ERR_MSG_INVALID_PARAMS)
-            int_quantity = int(quantity)
-            if int_quantity > 0:
-                product = Product.objects.filter(id=product_id)
-                if not product:
-                    return self.return_error(settings.ERR_MSG_NO_PRODUCT)
-                else:
-                    self.update_cart_with_product(
-                        product_id,
-                        quantity,
-                        product
-                    )
+            items.append((fields[0], int(fields[1])))
+        product_ids = [
+            int(product_id) for product_id, quantity in items if quantity > 0
+        ]
+        existing_ids = set(Product.objects.filter(
+            id__in=product_ids
+        ).values_list("id", flat=True))
+        if any(product_id not in existing_ids for product_id in product_ids):
+            return self.return_error(settings.ERR_MSG_NO_PRODUCT)
+        for product_id, quantity in items:
+            if quantity > 0:
+                self.update_cart_with_product(product_id, quantity)
             else:
                 self.delete_product_from_cart(product_id)
-        self.request.session.save()
         self.items_in_cart = len(self.request.session["cart"])
         self.set_cart()
+        # The nested cart dict changes are not tracked by the session,
+        # so it's marked as modified to be saved once by the middleware.
+        self.request.session.modified = True
         return self.return_json()
 
     def return_error(self, error):
         """
-        Eventually returns JsonResponse
+        Eventually returns a JSON response
         with a certain AJAX error.
 
         :param error: The error message
@@ -259,33 +401,20 @@ class AJAXSessionCart(TemplateView):
         :param var: product_id
         :type var: str
         """
-        try:
-            del self.request.session["cart"][product_id]
-        except KeyError:
-            pass
+        self.request.session["cart"].pop(product_id, None)
 
-    def update_cart_with_product(self, product_id, quantity, product):
+    def update_cart_with_product(self, product_id, quantity):
         """
         Adds/updates a product in cart.
+        Only the quantity is stored, so the product data
+        is loaded from the DB when the cart is displayed.
 
         :param product_id: The product id
         :type product_id: str
         :param quantity: Quantity
-        :type quantity: str
-        :param product: The product filtered queryset
-        :type product: QuerySet
+        :type quantity: int
         """
-        product_data = {
-                k: str(v) for k, v in
-                product.values()[0].items()
-            }
-        self.request.session["cart"].update(
-            {product_id: {
-                "quantity": quantity,
-                "product_data": product_data
-                }
-             }
-        )
+        self.request.session["cart"][product_id] = quantity
 
     def return_json(self):
         """
@@ -297,19 +426,20 @@ class AJAXSessionCart(TemplateView):
             'items_in_cart': self.items_in_cart,
             'cart': self.cart
         }
-        return JsonResponse(data)
+        return HttpResponse(json_dumps(data), content_type="application/json")
 
     def is_valid_ajax_input(self, fields):
         """
         Returns True if all the fields
         are string representaions of integers,
-        e.g. "4", "6"
+        e.g. "4", "6". Checks each field in a single pass
+        with a precompiled pattern, which unlike str.isdigit()
+        doesn't accept non-ASCII digits that int() can't parse.
 
         :param fields: A tuple with the fields
         :type fields: tuple
         """
-        if any(isinstance(f, str) is not True for f in fields):
-            return False
-        if any(f.isdigit() is not True for f in fields):
-            return False
-        return True
+        return all(
+            isinstance(f, str) and DIGITS_RE.fullmatch(f) is not None
+            for f in fields
+        )
@@ -71,6 +71,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'ebag.context_processors.common_data',
             ],
         },
     },
@@ -141,6 +142,10 @@ MPTT_ADMIN_LEVEL_INDENT = 20
 # String for replacement with item id
 PK_PLACEHOLDER = "{%pk%}"
 
+# Cache key and timeout (in seconds) of the categories tree
+CATEGORIES_CACHE_KEY = "categories_all"
+CATEGORIES_CACHE_TIMEOUT = 300
+
 # AJAX error messages
 ERR_MSG_NO_PRODUCT = "Invalid product_id!"
 ERR_MSG_INVALID_PARAMS = "Invalid parameters!"